@@ -38,7 +38,9 @@ MANAGEIQ_MODULE_VARS = ('username',
                         'manageiq_validate_certs',
                         'force_basic_auth',
                         'client_cert',
-                        'client_key')
+                        'client_key',
+                        'max_retries',
+                        'retry_backoff')
 
 
 class ActionModule(ActionBase):
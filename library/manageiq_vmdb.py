@@ -18,11 +18,9 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from __future__ import (absolute_import, division, print_function)
+import io
 import os
 
-__metaclass__ = type
-
 ANSIBLE_METADATA = {'metadata_version': '1.1',
                     'status': ['preview'],
                     'supported_by': 'community'}
@@ -30,75 +28,276 @@ ANSIBLE_METADATA = {'metadata_version': '1.1',
 
 DOCUMENTATION = '''
 module: manageiq_vmdb
+short_description: Query and modify ManageIQ VMDB objects
+description:
+  - Get a ManageIQ VMDB object, or call actions on it, through the ManageIQ REST API.
+options:
+  manageiq_connection:
+    description:
+      - ManageIQ connection details, see the role variables.
+    required: true
+    type: dict
+  vmdb:
+    description:
+      - A VMDB object, as registered from a previous call.
+    type: dict
+  href:
+    description:
+      - The href or href_slug of the VMDB object.
+    type: str
+  action:
+    description:
+      - The action to call on the VMDB object.
+    type: str
+  data:
+    description:
+      - The resource passed to I(action).
+      - A string is decoded first, as a JSON list or as a dict in JSON or
+        C(key=value) form.
+      - A dict is sent as the single C(resource) of the action.
+      - A list is sent in one bulk request as C(resources), use a collection
+        href and give each item its own C(href). The per item results are
+        returned in C(results).
+    type: raw
+  actions:
+    description:
+      - A list of independent actions, each a dict with C(href) or C(vmdb),
+        C(action) and C(data).
+      - The actions are sent concurrently and the per item results are
+        returned in C(results).
+      - Mutually exclusive with I(action), I(href) and I(vmdb).
+    type: list
+    elements: dict
 '''
-import json
 import re
+import time
+from multiprocessing.pool import ThreadPool
+from urllib.parse import urlparse
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.common.validation import check_type_dict
 from ansible.module_utils.urls import fetch_url
-from ansible.module_utils.six.moves.urllib.parse import urlparse
+
+try:
+    import orjson as _json
+    HAS_ORJSON = True
+except ImportError:
+    import json as _json
+    HAS_ORJSON = False
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.exceptions import NewConnectionError
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
+try:
+    import httpx
+    import h2  # noqa: F401, required by httpx for http2
+    HAS_HTTPX = True
+except ImportError:
+    HAS_HTTPX = False
+
+MAX_CONCURRENT_ACTIONS = 4
+# Seconds, the fetch_url default, so every transport gives up on a stalled appliance
+REQUEST_TIMEOUT = 10
+TRANSIENT_STATUSES = (502, 503, 504)
+# Shared by every instance without a token, never modified in place
+_BASE_HEADERS = {'Content-Type': 'application/json; charset=utf-8'}
+
+
+def _load(result):
+    """
+        Decode a JSON response, the stdlib reads it straight off the response object
+    """
+    if HAS_ORJSON:
+        return _json.loads(result.read())
+    return _json.load(result)
+
 
 class ManageIQVmdb(object):
     """
         Object to execute VMDB management operations in manageiq.
     """
 
-    def __init__(self, module):
+    def __init__(self, module, connection):
         self._module = module
+        self._connection = connection
         self._debug = bool(self._module._verbosity >= 3)
-        self._api_url = self._module.params['manageiq_connection']['url']
+        self._timeout = REQUEST_TIMEOUT
+        self._api_url = self._connection['url']
         self._vmdb = self._module.params.get('vmdb') or self._module.params.get('href')
         self._href = None
+        self._url = None
+        self.parse(self._vmdb)
         self._error = None
         self._auth = self._build_auth()
+        self._session = self._build_session()
 
 
     def _build_auth(self):
-        self._headers = {'Content-Type': 'application/json; charset=utf-8'}
+        self._headers = _BASE_HEADERS
         # Force CERT validation to work with fetch_url
-        self._module.params['validate_certs'] = self._module.params['manageiq_connection']['manageiq_validate_certs']
+        self._module.params['validate_certs'] = self._connection['manageiq_validate_certs']
         for cert in ('force_basic_auth', 'client_cert', 'client_key'):
-            self._module.params[cert] = self._module.params['manageiq_connection'][cert]
-        if self._module.params['manageiq_connection'].get('token'):
-            self._headers["X-Auth-Token"] = self._module.params['manageiq_connection']['token']
+            self._module.params[cert] = self._connection[cert]
+        if self._connection.get('token'):
+            self._headers = dict(_BASE_HEADERS)
+            self._headers["X-Auth-Token"] = self._connection['token']
         else:
-            self._module.params['url_username'] = self._module.params['manageiq_connection']['username']
-            self._module.params['url_password'] = self._module.params['manageiq_connection']['password']
+            self._module.params['url_username'] = self._connection['username']
+            self._module.params['url_password'] = self._connection['password']
 
 
+    def _session_options(self):
+        """
+            The cert validation, client cert and basic auth shared by both session types
+        """
+        cert = self._module.params['client_cert']
+        if cert and self._module.params['client_key']:
+            cert = (cert, self._module.params['client_key'])
+        auth = None
+        if self._module.params.get('url_username'):
+            auth = (self._module.params['url_username'], self._module.params['url_password'])
+        return self._module.params['validate_certs'], cert, auth
+
+
+    def _build_session(self):
+        """
+            Build a keep-alive session so every call in this run reuses one connection.
+            httpx multiplexes concurrent actions over one HTTP/2 connection when the server allows it.
+        """
+        verify, cert, auth = self._session_options()
+        if HAS_HTTPX:
+            limits = httpx.Limits(max_connections=MAX_CONCURRENT_ACTIONS, max_keepalive_connections=1)
+            return httpx.Client(http2=True, limits=limits, headers=self._headers, timeout=self._timeout,
+                                follow_redirects=True, verify=verify, cert=cert, auth=auth)
+        if not HAS_REQUESTS:
+            return None
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_ACTIONS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self._headers)
+        session.verify = verify
+        session.cert = cert
+        session.auth = auth
+        return session
 
 
     @property
     def url(self):
         """
-            The url to connect to the VMDB Object
+            The url to connect to the VMDB Object, built when parse() sets the href
         """
-        return self.build_url()
+        return self._url
 
 
-    def build_url(self):
+    def build_url(self, href=None):
         """
             Using any type of href input, build out the correct url
         """
 
-        url_actual = urlparse(self._href)
+        url_actual = urlparse(href or self._href)
         if re.search('api', url_actual.path):
             return self._api_url + url_actual.path
         return self._api_url + '/api/' + url_actual.path
 
 
+    def _send(self, method, data=None, url=None):
+        """
+            Send the request, retrying transient failures with an exponential backoff
+        """
+        retries = self._connection['max_retries']
+        backoff = self._connection['retry_backoff']
+        for attempt in range(retries + 1):
+            result, info = self._send_once(method, data, url)
+            if result is not None or attempt == retries or not self._retryable(method, info):
+                return result, info
+            time.sleep(backoff * 2 ** attempt)
+
+
+    def _retryable(self, method, info):
+        """
+            GETs retry transient failures. Actions are not idempotent, so a POST is only
+            retried when the connection could not be opened and the request never left the client.
+        """
+        if info.get('connect_error'):
+            return True
+        if method != 'get':
+            return False
+        status = info.get('status', -1)
+        return status < 0 or status in TRANSIENT_STATUSES
+
+
+    def _send_once(self, method, data=None, url=None):
+        """
+            Send the request over the session, falling back to fetch_url
+        """
+        url = url or self.url
+        if self._session is None:
+            result, info = fetch_url(self._module, url, data, self._headers, method, timeout=self._timeout)
+            if not 200 <= info.get('status', -1) < 300:
+                return None, info
+            return result, info
+        if HAS_HTTPX:
+            return self._send_httpx(method, data, url)
+        try:
+            response = self._session.request(method, url, data=data, timeout=self._timeout)
+        except requests.exceptions.RequestException as err:
+            reason = getattr(err.args[0], 'reason', None) if err.args else None
+            connect_error = isinstance(err, requests.exceptions.ConnectTimeout) or isinstance(reason, NewConnectionError)
+            return None, dict(url=url, status=-1, msg=str(err), connect_error=connect_error)
+        info = dict(url=response.url, status=response.status_code, msg=response.reason)
+        if not response.ok:
+            info['body'] = response.text
+            return None, info
+        return io.BytesIO(response.content), info
+
+
+    def _send_httpx(self, method, data, url):
+        """
+            Send the request over the httpx client
+        """
+        try:
+            response = self._session.request(method.upper(), url, content=data)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as err:
+            return None, dict(url=url, status=-1, msg=str(err), connect_error=True)
+        except httpx.HTTPError as err:
+            return None, dict(url=url, status=-1, msg=str(err))
+        info = dict(url=str(response.url), status=response.status_code, msg=response.reason_phrase,
+                    http_version=response.http_version)
+        if not 200 <= response.status_code < 300:
+            info['body'] = response.text
+            return None, info
+        return response, info
+
+
     def build_result(self, method, data=None):
         """
             Make the REST call and return the result to the caller
         """
-        result, info = fetch_url(self._module, self.url, data, self._headers, method)
+        result, info = self._send(method, data)
         try:
-            vmdb = json.loads(result.read())
+            vmdb = _load(result)
             if self._debug:
                 vmdb['debug'] = info
             return vmdb
         except AttributeError:
+            if method == 'post' and info.get('status') in (400, 404):
+                self._module.fail_json(msg=self._error_message(info) or "Action not found", info=info)
             self._module.fail_json(msg=info)
-        return json.loads(result.read())
+
+
+    def _error_message(self, info):
+        """
+            The error message ManageIQ returned in the response body, if any
+        """
+        try:
+            return _json.loads(info.get('body') or '')['error']['message']
+        except (ValueError, TypeError, KeyError):
+            return None
 
 
     def get(self):
@@ -110,29 +309,42 @@ class ManageIQVmdb(object):
 
     def set(self, post_dict):
         """
-            Set any attribute, object from the REST API
+            Set any attribute, object from the REST API.
+            post_dict is the request body, an action with either a resource or resources.
         """
-        post_data = json.dumps(dict(action=post_dict['action'], resource=post_dict['resource']))
+        post_data = _json.dumps(post_dict)
         return self.build_result('post', post_data)
 
 
+    def parse_href(self, item):
+        """
+            Return the href of a VMDB object or href slug
+        """
+        if type(item) is str:
+            slug = item.split("::", 1)
+            if len(slug) == 2:
+                return slug[1]
+            return item
+        elif type(item) is dict:
+            return item.get('href')
+        return None
+
+
     def parse(self, item):
         """
             Read what is passed in and set the _href instance variable
         """
-        if isinstance(item, dict):
-            self._href = self._vmdb['href']
-        elif isinstance(item, str):
-            slug = item.split("::")
-            if len(slug) == 2:
-                self._href = slug[1]
-                return
-            self._href = item
+        self._href = self.parse_href(item)
+        if self._href is not None:
+            self._url = self.build_url()
+        elif item is not None:
+            self._module.fail_json(msg="The vmdb object has no href")
 
 
     def exists(self, path):
         """
-            Validate all passed objects before attempting to set or get values from them
+            Validate all passed objects before attempting to set or get values from them.
+            Not used by action(), which lets the server reject unknown actions instead.
         """
         result = self.get()
         actions = [d['name'] for d in result['actions']]
@@ -148,24 +360,72 @@ class Vmdb(ManageIQVmdb):
         """
             Return the VMDB Object
         """
-        self.parse(self._vmdb)
-        return dict(self.get())
+        return self.get()
 
 
     def action(self):
         """
-            Call an action if it exists
+            Call an action, the server rejects it if it does not exist
         """
-        self.parse(self._vmdb)
         data = self._module.params['data']
         action_string = self._module.params.get('action')
 
-        if self.exists(action_string):
-            result = self.set(dict(action=action_string, resource=data))
-            if result or result['success']:
-                return dict(changed=True, value=result)
-            return self._module.fail_json(msg=result['message'])
-        return self._module.fail_json(msg="Action not found")
+        if isinstance(data, str):
+            try:
+                data = _json.loads(data) if data.lstrip().startswith('[') else check_type_dict(data)
+            except (TypeError, ValueError) as err:
+                return self._module.fail_json(msg="data must be a dict or a list: %s" % err)
+        if data is not None and not isinstance(data, (dict, list)):
+            return self._module.fail_json(msg="data must be a dict or a list, got %s" % type(data).__name__)
+        if isinstance(data, list):
+            return self.bulk_action(action_string, data)
+        result = self.set(dict(action=action_string, resource=data))
+        if result.get('success', True):
+            return dict(changed=True, value=result)
+        return self._module.fail_json(msg=result.get('message', "Action not found"))
+
+
+    def bulk_action(self, action_string, resources):
+        """
+            Call an action on a list of resources in a single request
+        """
+        result = self.set(dict(action=action_string, resources=resources))
+        results = result.get('results', [])
+        failed = [r.get('message') for r in results if not r.get('success', True)]
+        if failed:
+            return self._module.fail_json(msg=failed, results=results)
+        return dict(changed=True, value=result, results=results)
+
+
+    def run_actions(self):
+        """
+            Call a list of independent actions concurrently over the shared session
+        """
+        items = self._module.params['actions']
+        with ThreadPool(min(len(items), MAX_CONCURRENT_ACTIONS)) as pool:
+            results = pool.map(self._run_action_item, items)
+        failed = [r.get('message') for r in results if not r.get('success', True)]
+        if failed:
+            return self._module.fail_json(msg=failed, results=results)
+        return dict(changed=True, results=results)
+
+
+    def _run_action_item(self, item):
+        """
+            POST one entry of the actions list, errors are returned rather than failing the module
+        """
+        href = self.parse_href(item.get('vmdb') or item.get('href'))
+        if href is None:
+            return dict(success=False, message="No href given, in href or the vmdb object, for action %s" % item.get('action'))
+        url = self.build_url(href)
+        post_data = _json.dumps(dict(action=item.get('action'), resource=item.get('data')))
+        result, info = self._send('post', post_data, url)
+        if result is None:
+            return dict(success=False, message=self._error_message(info) or info.get('msg'), href=url)
+        try:
+            return _load(result)
+        except ValueError as err:
+            return dict(success=False, message="Invalid JSON response: %s" % err, href=url)
 
 
 def manageiq_argument_spec():
@@ -180,10 +440,25 @@ def manageiq_argument_spec():
         manageiq_validate_certs=dict(required=False, type='bool', default=True),
         force_basic_auth=dict(required=False, type='bool', default='no'),
         client_cert=dict(required=False, type='path', default=None),
-        client_key=dict(required=False, type='path', default=None)
+        client_key=dict(required=False, type='path', default=None),
+        max_retries=dict(required=False, type='int', default=2),
+        retry_backoff=dict(required=False, type='float', default=0.2)
     )
 
 
+def validate_connection_params(module):
+    """
+        Validate the manageiq_connection once and return it
+    """
+    connection = module.params['manageiq_connection']
+    if not connection.get('url'):
+        module.fail_json(msg="manageiq_connection url is required, set it or the MIQ_URL environment variable")
+    for option in ('max_retries', 'retry_backoff'):
+        if connection[option] < 0:
+            module.fail_json(msg="manageiq_connection %s must be 0 or higher" % option)
+    return connection
+
+
 def main():
     """
         The entry point to the ManageIQ Vmdb module
@@ -195,15 +470,25 @@ def main():
                 vmdb=dict(required=False, type='dict'),
                 action=dict(required=False, type='str'),
                 href=dict(required=False, type='str'),
-                data=dict(required=False, type='dict')
+                data=dict(required=False, type='raw'),
+                actions=dict(required=False, type='list', elements='dict',
+                             options=dict(href=dict(required=False, type='str'),
+                                          vmdb=dict(required=False, type='dict'),
+                                          action=dict(required=True, type='str'),
+                                          data=dict(required=False, type='dict')))
                 ),
-            required_one_of=[['vmdb', 'href']]
+            required_one_of=[['vmdb', 'href', 'actions']],
+            mutually_exclusive=[['actions', 'action'], ['actions', 'href'], ['actions', 'vmdb']]
             )
 
 
-    vmdb = Vmdb(module)
+    connection = validate_connection_params(module)
+    vmdb = Vmdb(module, connection)
 
-    if module.params.get('action'):
+    if module.params.get('actions'):
+        result = vmdb.run_actions()
+        module.exit_json(**result)
+    elif module.params.get('action'):
         result = vmdb.action()
         module.exit_json(**result)
     else:
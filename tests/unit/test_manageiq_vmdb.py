@@ -0,0 +1,163 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('ansible')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'library'))
+import manageiq_vmdb  # noqa: E402
+
+
+class ModuleExit(Exception):
+    pass
+
+
+class FakeModule(object):
+    _verbosity = 0
+
+    def __init__(self, **params):
+        self.params = dict(vmdb=None, href=None, action=None, data=None, actions=None)
+        self.params.update(params)
+
+    def fail_json(self, **kwargs):
+        raise ModuleExit(dict(kwargs, failed=True))
+
+
+CONNECTION = dict(url='https://miq.example.com', username='admin', password='smartvm', token=None,
+                  manageiq_validate_certs=True, force_basic_auth=False, client_cert=None, client_key=None,
+                  max_retries=2, retry_backoff=0.0)
+
+
+@pytest.fixture
+def fetch_url(monkeypatch):
+    """
+        Stub fetch_url, queue responses in .responses and read sent requests from .calls
+    """
+    class FetchUrl(object):
+        def __init__(self):
+            self.calls = []
+            self.responses = []
+
+        def __call__(self, module, url, data=None, headers=None, method=None, timeout=10):
+            self.calls.append((method, url, json.loads(data) if data else None))
+            status, body = self.responses.pop(0)
+            info = dict(url=url, status=status)
+            if status != 200:
+                info['body'] = json.dumps(body)
+                return None, info
+            return io.BytesIO(json.dumps(body).encode('utf-8')), info
+
+    stub = FetchUrl()
+    monkeypatch.setattr(manageiq_vmdb, 'fetch_url', stub)
+    monkeypatch.setattr(manageiq_vmdb, 'HAS_REQUESTS', False)
+    monkeypatch.setattr(manageiq_vmdb, 'HAS_HTTPX', False)
+    return stub
+
+
+def vmdb(**params):
+    return manageiq_vmdb.Vmdb(FakeModule(**params), dict(CONNECTION))
+
+
+def test_sequential_calls_behave_the_same(fetch_url):
+    fetch_url.responses = [(200, dict(id=80)), (200, dict(id=80))]
+    obj = vmdb(href='href_slug::services/80')
+
+    assert obj.get_object() == obj.get_object() == dict(id=80)
+    assert fetch_url.calls == [('get', 'https://miq.example.com/api/services/80', None)] * 2
+
+
+def test_vmdb_object_href(fetch_url):
+    fetch_url.responses = [(200, dict(success=True))]
+    obj = vmdb(vmdb=dict(href='https://miq.example.com/api/services/3'), action='retire')
+
+    assert obj.action() == dict(changed=True, value=dict(success=True))
+    assert fetch_url.calls == [('post', 'https://miq.example.com/api/services/3',
+                                dict(action='retire', resource=None))]
+
+
+def test_vmdb_object_without_href_fails(fetch_url):
+    with pytest.raises(ModuleExit) as err:
+        vmdb(vmdb=dict(id=3))
+    assert err.value.args[0]['msg'] == "The vmdb object has no href"
+
+
+def test_action_reports_manageiq_error_message(fetch_url):
+    fetch_url.responses = [(400, dict(error=dict(kind='bad_request', message='Invalid attribute foo')))]
+
+    with pytest.raises(ModuleExit) as err:
+        vmdb(href='services/80', action='add_provider_vms', data=dict(foo=1)).action()
+    assert err.value.args[0]['msg'] == 'Invalid attribute foo'
+
+
+def test_action_not_found_without_message(fetch_url):
+    fetch_url.responses = [(404, None)]
+
+    with pytest.raises(ModuleExit) as err:
+        vmdb(href='services/80', action='nope').action()
+    assert err.value.args[0]['msg'] == 'Action not found'
+
+
+@pytest.mark.parametrize('data, resource', [
+    ('a=1, b=2', dict(a='1', b='2')),
+    ('{"a": 1}', dict(a=1)),
+])
+def test_action_decodes_string_data(fetch_url, data, resource):
+    fetch_url.responses = [(200, dict(success=True))]
+
+    vmdb(href='services/80', action='add', data=data).action()
+    assert fetch_url.calls[0][2] == dict(action='add', resource=resource)
+
+
+@pytest.mark.parametrize('data', ['junk', 5])
+def test_action_rejects_other_data(fetch_url, data):
+    with pytest.raises(ModuleExit):
+        vmdb(href='services/80', action='add', data=data).action()
+    assert fetch_url.calls == []
+
+
+def test_bulk_action_posts_resources_once(fetch_url):
+    results = [dict(success=True), dict(success=True)]
+    fetch_url.responses = [(200, dict(results=results))]
+
+    result = vmdb(href='services', action='assign_tags', data=[dict(href='vms/1'), dict(href='vms/2')]).action()
+    assert result['results'] == results
+    assert fetch_url.calls == [('post', 'https://miq.example.com/api/services',
+                                dict(action='assign_tags', resources=[dict(href='vms/1'), dict(href='vms/2')]))]
+
+
+def test_bulk_action_fails_on_failed_items(fetch_url):
+    fetch_url.responses = [(200, dict(results=[dict(success=True), dict(success=False, message='bad tag')]))]
+
+    with pytest.raises(ModuleExit) as err:
+        vmdb(href='vms', action='assign_tags', data=[dict(href='vms/1'), dict(href='vms/2')]).action()
+    assert err.value.args[0]['msg'] == ['bad tag']
+
+
+def test_run_actions_collects_item_errors(fetch_url):
+    fetch_url.responses = [(200, dict(success=True))]
+    actions = [dict(href='services/1', action='retire', vmdb=None, data=None),
+               dict(href=None, action='retire', vmdb=dict(id=2), data=None)]
+
+    with pytest.raises(ModuleExit) as err:
+        vmdb(actions=actions).run_actions()
+    results = err.value.args[0]['results']
+    assert results[0] == dict(success=True)
+    assert results[1]['success'] is False
+
+
+def test_get_retries_transient_failures(fetch_url):
+    fetch_url.responses = [(503, None), (504, None), (200, dict(id=80))]
+
+    assert vmdb(href='services/80').get_object() == dict(id=80)
+    assert len(fetch_url.calls) == 3
+
+
+def test_post_is_not_retried(fetch_url):
+    fetch_url.responses = [(504, None), (200, dict(success=True))]
+
+    with pytest.raises(ModuleExit):
+        vmdb(href='services/80', action='retire').action()
+    assert len(fetch_url.calls) == 1